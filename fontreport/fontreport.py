@@ -29,6 +29,9 @@ the glyphs supported by the font.
 from __future__ import print_function
 
 import argparse
+import collections
+import io
+import operator
 import os
 import re
 import subprocess
@@ -44,6 +47,13 @@ from . import version
 # TODO: Populate it with actual mapping.
 LANGUAGE_TAGS = {}
 
+# Translation table escaping characters that are special to TeX.
+TEX_ESCAPES = dict((ord(x), '\\' + x) for x in '_#&%{}[]')
+TEX_ESCAPES[ord('\n')] = '\\\\\n'
+
+# Write buffer for .tex output, large enough to batch many report rows.
+TEX_BUFFER_SIZE = 1 << 20
+
 
 class Error(Exception):
   pass
@@ -55,12 +65,17 @@ class Glyph(object):
   Contains glyph properties collected from different tables of a font and
   queried by report classes.
   """
+  # Fonts may contain tens of thousands of glyphs, avoid per-instance dicts.
+  __slots__ = ('name', 'tex_name', 'advance_width', 'lsb', 'class_def',
+               'class_name', 'sequences', 'alternates', 'chars', 'index')
 
   def __init__(self, name):
     self.name = name
-    self.advance_idth = None
+    self.tex_name = TexEscape(name)
+    self.advance_width = None
     self.lsb = None
     self.class_def = 0
+    self.class_name = None
     self.sequences = None
     self.alternates = None
     self.chars = []
@@ -70,6 +85,34 @@ class Glyph(object):
     return self.chars[idx] if self.chars else None
 
 
+def AddSingleSubstitutions(sub, idx, substitutes):
+  substitutes.extend(((k,), ((v,),), idx, 1) for k, v in sub.mapping.items())
+
+
+def AddMultipleSubstitutions(sub, idx, substitutes):
+  substitutes.extend(((k,), (tuple(v),), idx, 1)
+                     for k, v in sub.mapping.items())
+
+
+def AddAlternateSubstitutions(sub, idx, substitutes):
+  substitutes.extend(((k,), tuple((x,) for x in v), idx, 3)
+                     for k, v in sub.alternates.items())
+
+
+def AddLigatureSubstitutions(sub, idx, substitutes):
+  substitutes.extend(((key, *component.Component), ((component.LigGlyph,),),
+                      idx, 4)
+                     for key, value in sub.ligatures.items()
+                     for component in value)
+
+
+# Functions collecting substitution rules of a GSUB subtable, by lookup type.
+GSUB_HANDLERS = {1: AddSingleSubstitutions,
+                 2: AddMultipleSubstitutions,
+                 3: AddAlternateSubstitutions,
+                 4: AddLigatureSubstitutions}
+
+
 class FontFile(object):
   """Representation of font metadata.
 
@@ -81,6 +124,8 @@ class FontFile(object):
                 'Trademark': 7, 'Manufacturer': 8, 'Designer': 9,
                 'Description': 10, 'Vendor URL': 11, 'Designer URL': 12,
                 'License': 13, 'License URL': 14, 'Sample Text': 19}
+  # Only these name records are decoded up front.
+  NAME_IDS = frozenset(NAME_CODES.values())
 
   def __init__(self, filename, font_number=-1):
     self.filename = filename
@@ -88,29 +133,45 @@ class FontFile(object):
                                self.filename.startswith('./'))):
       self.filename = './' + self.filename
 
-    self.ttf = TTFont(filename, fontNumber=font_number, lazy=False)
+    self.ttf = TTFont(filename, fontNumber=font_number, lazy=True)
     self._names = {}
     self.chars = {}
+    self.sorted_chars = []
     self._glyphsmap = {}
     self.glyphs = []
-    self.features = {}
-    self.caret_list = {}
-    self.substitutes = set()
+    self.class_counts = collections.Counter()
+    self._features = None
+    self._features_by_table = None
+    self._substitutes = None
     self.caret_list = {}
     self._ParseNames()
     self._ParseCmap()
-    self._ParseGSUB()
     self._ParseGlyphs()
 
+  @property
+  def features(self):
+    if self._features is None:
+      self._ParseGSUB()
+    return self._features
+
+  @property
+  def substitutes(self):
+    if self._substitutes is None:
+      self._ParseGSUB()
+    return self._substitutes
+
   def _ParseNames(self):
     if 'name' in self.ttf:
       for name in self.ttf['name'].names:
-        if name.isUnicode():
-          text = name.string.decode('utf-16be')
-        else:
-          text = name.string.decode('latin1')
-        if name.nameID not in self._names:
-          self._names[name.nameID] = text
+        if name.nameID in self.NAME_IDS and name.nameID not in self._names:
+          self._names[name.nameID] = self._DecodeName(name)
+
+  @staticmethod
+  def _DecodeName(name):
+    if name.isUnicode():
+      return name.string.decode('utf-16be')
+    else:
+      return name.string.decode('latin1')
 
   def GetTables(self):
     return sorted(self.ttf.reader.keys())
@@ -134,73 +195,91 @@ class FontFile(object):
       return 'Author is not set'
 
   def GetFeaturesByTable(self):
+    if self._features_by_table is None:
+      self._features_by_table = self._ComputeFeaturesByTable()
+    return self._features_by_table
+
+  def _ComputeFeaturesByTable(self):
     mapping = {}
     for key, scripts in self.features.items():
       feature, tables = key
+      scripts = tuple(sorted(scripts))
       for table in tables:
-        if table not in mapping:
-          mapping[table] = set()
-        mapping[table].add((feature, tuple(sorted(scripts))))
+        mapping.setdefault(table, set()).add((feature, scripts))
     return mapping
 
   def _ParseCmap(self):
     if 'cmap' in self.ttf:
-      for table in self.ttf['cmap'].tables:
-        if table.isUnicode():
-          for code, name in table.cmap.items():
-            self.chars[code] = name
+      # Full repertoire subtables are supersets of the BMP ones, so only
+      # the best Unicode subtable needs to be decoded.
+      cmap = self.ttf['cmap']
+      best = cmap.getBestCmap()
+      if best is not None:
+        self.chars = dict(best)
+      else:
+        # getBestCmap() skips symbol (3, 0) subtables; merge them instead.
+        for table in cmap.tables:
+          if table.isUnicode():
+            self.chars.update(table.cmap)
+    self.sorted_chars = sorted(self.chars)
 
   def _ParseGSUB(self):
-    if 'GSUB' not in self.ttf:
-      return
-
-    if self.ttf['GSUB'].table.FeatureList:
-      scripts = [set() for unused_x
-                 in range(self.ttf['GSUB'].table.FeatureList.FeatureCount)]
+    """Collect GSUB features and substitutions, on first use.
+
+    Results are stored only once the whole table has been parsed. Raises
+    Error so that Envelope's AttributeError handling does not hide a
+    malformed table.
+    """
+    features = {}
+    substitutes = []
+    if 'GSUB' in self.ttf:
+      try:
+        subtables = self._ReadGSUBTable(self.ttf['GSUB'].table, features)
+      except AttributeError as e:
+        raise Error('Malformed GSUB table: %s' % e)
+      for idx, sub in subtables:
+        handler = GSUB_HANDLERS.get(sub.LookupType)
+        if handler:
+          handler(sub, idx, substitutes)
+        else:
+          print('Warning: Lookup table %d: type %s not yet supported.' % (
+              idx, sub.LookupType))
+    self._features = features
+    self._substitutes = substitutes
+
+  @staticmethod
+  def _ReadGSUBTable(gsub, features):
+    """Fills features and returns (lookup index, subtable) pairs."""
+    feature_list = gsub.FeatureList
+    if feature_list:
+      scripts = [set() for unused_x in range(feature_list.FeatureCount)]
     else:
       scripts = []
     # Find scripts defined in a font
-    for script in self.ttf['GSUB'].table.ScriptList.ScriptRecord:
+    for script in gsub.ScriptList.ScriptRecord:
       if script.Script.DefaultLangSys:
+        tag = script.ScriptTag
         for idx in script.Script.DefaultLangSys.FeatureIndex:
-          scripts[idx].add(script.ScriptTag)
+          scripts[idx].add(tag)
       for lang in script.Script.LangSysRecord:
+        tag = script.ScriptTag + '-' + lang.LangSysTag.strip()
         for idx in lang.LangSys.FeatureIndex:
-          scripts[idx].add(script.ScriptTag + '-' + lang.LangSysTag.strip())
+          scripts[idx].add(tag)
 
     # Find all featrures defined in a font
-    if hasattr(self.ttf['GSUB'].table, 'FeatureList'):
-      for idx, feature in enumerate(
-          self.ttf['GSUB'].table.FeatureList.FeatureRecord):
+    if feature_list:
+      for idx, feature in enumerate(feature_list.FeatureRecord):
         key = (feature.FeatureTag, tuple(feature.Feature.LookupListIndex))
-        if key not in self.features:
-          self.features[key] = set()
-        self.features[key].update(scripts[idx])
-
-    if not self.ttf['GSUB'].table.LookupList:
-      return
-    for idx, lookup in enumerate(self.ttf['GSUB'].table.LookupList.Lookup):
-      for sub in lookup.SubTable:
-        if sub.LookupType == 7:
-          sub = sub.ExtSubTable
-        if sub.LookupType == 1:
-          for k, v in sub.mapping.items():
-            self.substitutes.add(((k,), ((v,),), idx, 1))
-        elif sub.LookupType == 2:
-          for k, v in sub.mapping.items():
-            self.substitutes.add(((k,), (tuple(v),), idx, 1))
-        elif sub.LookupType == 3:
-          for k, v in sub.alternates.items():
-            self.substitutes.add(((k,), tuple((x,) for x in v), idx, 3))
-        elif sub.LookupType == 4:
-          for key, value in sub.ligatures.items():
-            for component in value:
-              sequence = tuple([key] + component.Component)
-              glyph = component.LigGlyph
-              self.substitutes.add((sequence, ((glyph,),), idx, 4))
-        else:
-          print('Warning: Lookup table %d: type %s not yet supported.' % (
-              idx, sub.LookupType))
+        features.setdefault(key, set()).update(scripts[idx])
+
+    subtables = []
+    if gsub.LookupList:
+      for idx, lookup in enumerate(gsub.LookupList.Lookup):
+        for sub in lookup.SubTable:
+          if sub.LookupType == 7:
+            sub = sub.ExtSubTable
+          subtables.append((idx, sub))
+    return subtables
 
   def _ParseGlyphs(self):
     """Fetch available glyphs."""
@@ -208,48 +287,59 @@ class FontFile(object):
     class_names = {2: 'ligature', 3: 'mark', 4: 'component'}
     metrics = {}
     if 'GDEF' in self.ttf:
-      class_defs = self.ttf['GDEF'].table.GlyphClassDef.classDefs
-      caret_list = self.ttf['GDEF'].table.LigCaretList
+      gdef = self.ttf['GDEF'].table
+      if gdef.GlyphClassDef:
+        class_defs = gdef.GlyphClassDef.classDefs
+      caret_list = gdef.LigCaretList
       if caret_list:
-        carets = [tuple(str(x.Coordinate) for x in y.CaretValue)
+        carets = [tuple(x.Coordinate for x in y.CaretValue)
                   for y in caret_list.LigGlyph]
         self.caret_list = dict(zip(caret_list.Coverage.glyphs, carets))
 
     if 'hmtx' in self.ttf:
       metrics = self.ttf['hmtx'].metrics
 
+    # Walk the code points in order so each glyph's list comes out sorted.
+    chars_by_glyph = collections.defaultdict(list)
+    for code in self.sorted_chars:
+      chars_by_glyph[self.chars[code]].append(code)
+
     for idx, name in enumerate(self.ttf.getGlyphOrder()):
       glyph = Glyph(name)
       glyph.index = idx
+      glyph.chars = chars_by_glyph.pop(name, [])
       glyph.advance_width, glyph.lsb = metrics.get(name, [None, None])
       glyph.class_def = class_defs.get(name, 0)
       glyph.class_name = class_names.get(glyph.class_def, None)
       self.glyphs.append(glyph)
       self._glyphsmap[name] = glyph
-    for k, v in self.chars.items():
-      try:
-        self._glyphsmap[v].chars.append(k)
-      except KeyError:
-        print('%s is mapped to non-existent glyph %s' % (k, v))
+    self.class_counts.update(x.class_def for x in self.glyphs)
+    for name, codes in chars_by_glyph.items():
+      for code in codes:
+        print('%s is mapped to non-existent glyph %s' % (code, name))
 
   def GetName(self, name, default=None):
     return self._names.get(self.NAME_CODES[name], default)
 
   def GetNames(self):
-    return ['%d: %s' % (k, v) for k, v in sorted(self._names.items())]
+    names = {}
+    if 'name' in self.ttf:
+      for name in self.ttf['name'].names:
+        if name.nameID not in names:
+          names[name.nameID] = self._DecodeName(name)
+    return ['%d: %s' % (k, v) for k, v in sorted(names.items())]
 
   def GetGlyph(self, name):
     return self._glyphsmap[name]
 
   def GetGSUBItems(self):
-    features_mapping = self.GetFeaturesByTable()
+    tables = {}
+    for table, features in self.GetFeaturesByTable().items():
+      tables[table] = (sorted(set(k for k, v in features)),
+                       sorted(set(x for k, v in features for x in v)))
     for src, dest, table, unused_kind in sorted(
         self.substitutes, key=lambda x: (x[2], x[0])):
-      if table in features_mapping:
-        features = sorted(set(k for k, v in features_mapping[table]))
-        langs = sorted(set(x for k, v in features_mapping[table] for x in v))
-      else:
-        features, langs = (), ()
+      features, langs = tables.get(table, ((), ()))
       yield (table, features, langs, src, dest)
 
 
@@ -269,10 +359,26 @@ class Report(object):
     pass
 
   def Xetex(self):
-    body = self.XetexBody()
-    if body:
-      body = self.TETEX_HEADER + body + self.TETEX_FOOTER
-    return body
+    return ''.join(self.IterXetex())
+
+  def IterXetex(self):
+    """Generates the TeX report piece by piece.
+
+    Nothing is generated if the report body is empty.
+    """
+    body = iter(self.IterXetexBody())
+    first = next(body, '')
+    if first:
+      yield self.TETEX_HEADER
+      yield first
+      for piece in body:
+        yield piece
+      yield self.TETEX_FOOTER
+
+  # Subclasses implement either of XetexBody or IterXetexBody, the latter
+  # is preferred for reports with a row per glyph or character.
+  def IterXetexBody(self):
+    yield self.XetexBody()
 
 class NamesReport(Report):
   """Report font names info."""
@@ -288,22 +394,23 @@ class NamesReport(Report):
 
   NAME = 'Font Metadata'
 
+  # Reported name categories, in name ID order.
+  CATEGORIES = tuple(sorted(FontFile.NAME_CODES.items(), key=lambda x: x[1]))
+
   def Plaintext(self):
-    data = ''
-    for category, code in sorted(FontFile.NAME_CODES.items(),
-                                 key=lambda x:x[1]):
+    data = []
+    for category, code in self.CATEGORIES:
       if code in self.font._names:
-        data += '%15s: %s\n' % (category, self.font._names[code])
-    return data
+        data.append('%15s: %s\n' % (category, self.font._names[code]))
+    return ''.join(data)
 
   def XetexBody(self):
-    data = ''
-    for category, code in sorted(FontFile.NAME_CODES.items(),
-                                 key=lambda x:x[1]):
+    data = []
+    for category, code in self.CATEGORIES:
       if code in self.font._names:
-        data += '%s & %s \\\\\n' % (category,
-                                    TexEscape(self.font._names[code]))
-    return data
+        data.append('%s & %s \\\\\n' % (
+            category, TexEscape(self.font._names[code])))
+    return ''.join(data)
 
 class UnicodeCoverageReport(Report):
   """Report font unicode coverage."""
@@ -321,33 +428,27 @@ class UnicodeCoverageReport(Report):
   NAME = 'Unicode Coverage'
 
   def Plaintext(self):
-    data = ''
-    for code, name in sorted(self.font.chars.items()):
-      try:
-        uniname = unicodedata.name(unichr(code))
-      except ValueError:
-        uniname = ''
-      data += '  U+%04X [%c] %-30s %s\n' % (code, unichr(code), name, uniname)
-    return data
-
-  def XetexBody(self):
-    data = ''
+    data = []
+    for code in self.font.sorted_chars:
+      name = self.font.chars[code]
+      uniname = unicodedata.name(unichr(code), '')
+      data.append('  U+%04X [%c] %-30s %s\n' % (
+          code, unichr(code), name, uniname))
+    return ''.join(data)
+
+  def IterXetexBody(self):
     prevcode = 0
-    for code in sorted(self.font.chars):
-      try:
-        uniname = unicodedata.name(unichr(code))
-      except ValueError:
-        uniname = ''
+    for code in self.font.sorted_chars:
+      uniname = unicodedata.name(unichr(code), '')
       if code - prevcode > 1:
-        gaps = len([x for x in  range(prevcode + 1, code)
-                    if unicodedata.category(unichr(x))[0] != 'C'])
+        gaps = CountVisibleCharacters(prevcode + 1, code)
         if gaps:
-          data += ('\\rowcolor{missing}\\multicolumn{3}{|c|}'
-                   '{\\small %d visible characters not mapped to glyphs} \\\\\n') % (gaps)
+          yield ('\\rowcolor{missing}\\multicolumn{3}{|c|}'
+                 '{\\small %d visible characters not mapped to glyphs}'
+                 ' \\\\\n') % (gaps)
       prevcode = code
-      data += ('\\texttt{%04X} & {\\customfont\\symbol{%d}} &'
-               '{\\small %s}\\\\\n') % (code, code, uniname)
-    return data
+      yield ('\\texttt{%04X} & {\\customfont\\symbol{%d}} &'
+             '{\\small %s}\\\\\n') % (code, code, uniname)
 
 
 class GlyphsReport(Report):
@@ -369,32 +470,22 @@ class GlyphsReport(Report):
 
   TETEX_FOOTER = r'\end{longtable}'
 
+  # Glyph attributes listed in the plain-text report.
+  FIELDS = operator.attrgetter('index', 'name', 'advance_width', 'lsb',
+                               'class_def')
+
   def Plaintext(self):
-    data = ''
-    for glyph in self.font.glyphs:
-      data += '%6d %-30s %6d %6d %3d\n' % (
-          glyph.index, glyph.name, glyph.advance_width,
-          glyph.lsb, glyph.class_def)
-    return data
+    return ''.join('%6d %-30s %6d %6d %3d\n' % x
+                   for x in map(self.FIELDS, self.font.glyphs))
 
-  def XetexBody(self):
-    data = ''
-    uni = {}
-    for code, name in self.font.chars.items():
-      if name not in uni:
-        uni[name] = []
-      uni[name].append(code)
+  def IterXetexBody(self):
     for glyph in self.font.glyphs:
       if glyph.class_name:
-        data += '\\rowcolor{%s}\n' % glyph.class_name
-      if glyph.name in uni:
-        chars = ', '.join('u%04X' % x for x in glyph.chars)
-      else:
-        chars = ''
-      data += '%d & %s & %s & %d & %d & %d & %s\\\\\n' % (
-          glyph.index, TexGlyph(glyph), TexEscape(glyph.name),
+        yield '\\rowcolor{%s}\n' % glyph.class_name
+      chars = ', '.join('u%04X' % x for x in glyph.chars)
+      yield '%d & %s & %s & %d & %d & %d & %s\\\\\n' % (
+          glyph.index, TexGlyph(glyph), glyph.tex_name,
           glyph.advance_width, glyph.lsb, glyph.class_def, chars)
-    return data
 
 
 class LigaturesReport(Report):
@@ -414,20 +505,18 @@ class LigaturesReport(Report):
   NAME = 'Ligatures with Carets'
 
   def Plaintext(self):
-    data = ''
+    data = []
     for glyph, caret_list in sorted(self.font.caret_list.items()):
-      data += '%-10s\t%s\t%s\n' % (
-          glyph, ', '.join(caret_list), '-')
-    return data
+      data.append('%-10s\t%s\t%s\n' % (
+          glyph, ', '.join(map(str, caret_list)), '-'))
+    return ''.join(data)
 
-  def XetexBody(self):
-    data = ''
-    for glyph, caret_list in sorted(self.font.caret_list.items()):
-      coords = ', '.join(str(x) for x in caret_list)
-      data += '%s(%s) & %s & %s \\\\\n' % (
-          TexGlyph(self.font.GetGlyph(glyph)), TexEscape(glyph),
-          coords, '-')
-    return data
+  def IterXetexBody(self):
+    for name, caret_list in sorted(self.font.caret_list.items()):
+      glyph = self.font.GetGlyph(name)
+      coords = ', '.join(map(str, caret_list))
+      yield '%s(%s) & %s & %s \\\\\n' % (
+          TexGlyph(glyph), glyph.tex_name, coords, '-')
 
 
 class ChartReport(Report):
@@ -452,33 +541,29 @@ class ChartReport(Report):
     return data
 
   def GenerateBlocks(self, rows, cols):
-    def NewBlock():
-      return [False for x in range(rows * cols)]
     current_block = -1
     block = None
     span = rows * cols
-    for code in sorted(self.font.chars):
-      blockno = code / span
-      offset = code % span
+    for code in self.font.sorted_chars:
+      blockno, offset = divmod(code, span)
       if current_block != blockno:
         if block:
           yield current_block * span, block
-        block = NewBlock()
+        block = bytearray(span)
         current_block = blockno
-      block[offset] = True
+      block[offset] = 1
     if block:
       yield current_block * span, block
 
-  def XetexBody(self):
-    data = ''
+  def IterXetexBody(self):
     for idx, block in self.GenerateBlocks(self.ROWS, self.COLUMNS):
       subtitle = '%04X - %04X' % (idx,
                                   idx + self.ROWS * self.COLUMNS - 1)
-      data += self.CHART_HEADER % subtitle
-      data += '&' + ' & '.join('\\multicolumn{1}{c%s}{%03X}' % (
+      yield self.CHART_HEADER % subtitle
+      yield '&' + ' & '.join('\\multicolumn{1}{c%s}{%03X}' % (
           '|' if x == self.COLUMNS -1 else '',
-          idx / self.COLUMNS + x, ) for x in range(self.COLUMNS))
-      data += '\\\\\n\\cline{2-17}\n'
+          idx // self.COLUMNS + x, ) for x in range(self.COLUMNS))
+      yield '\\\\\n\\cline{2-17}\n'
       for row_idx in range(self.ROWS):
         row = ['\small{%X}' % row_idx]
         for col_idx in range(self.COLUMNS):
@@ -489,9 +574,8 @@ class ChartReport(Report):
           else:
             cell = '\\cellcolor{red}{\\cell{0}{%04X}}' % (code)
           row.append(cell)
-        data += ' & '.join(row) + '\\\\\n\\cline{2-17}\n'
-      data += self.CHART_FOOTER
-    return data
+        yield ' & '.join(row) + '\\\\\n\\cline{2-17}\n'
+      yield self.CHART_FOOTER
 
 
 class GridReport(Report):
@@ -643,28 +727,29 @@ class SubstitutionsReport(Report):
   NAME = 'GSUB Substitutions'
 
   def Plaintext(self):
-    data = ''
+    data = []
     for table, features, unused_langs, src, dest in self.font.GetGSUBItems():
-      data += '%4d\t%-20s\t%s\n' % (
+      data.append('%4d\t%-20s\t%s\n' % (
           table,
           ', '.join(features),
           ' '.join(src) + ' -> ' +
-          ', '.join(' '.join(y) for y in dest))
-    return data
+          ', '.join(' '.join(y) for y in dest)))
+    return ''.join(data)
+
+  def IterXetexBody(self):
+    # The same glyphs show up in many rules, format each of them once.
+    cells = {}
+    def Cell(name):
+      if name not in cells:
+        glyph = self.font.GetGlyph(name)
+        cells[name] = '%s(%s)' % (TexGlyph(glyph), glyph.tex_name)
+      return cells[name]
 
-  def XetexBody(self):
-    features_mapping = self.font.GetFeaturesByTable()
-    data = ''
     for table, features, unused_langs, src, dest in self.font.GetGSUBItems():
-      sequence = ' '.join('%s(%s)' % (
-          TexGlyph(self.font.GetGlyph(x)),
-          TexEscape(x)) for x in src)
-      alternates = ', '.join(' '.join('%s(%s)' % (
-          TexGlyph(self.font.GetGlyph(x)),
-          TexEscape(x)) for x in y) for y in dest)
-      data += '%d & %s & %s$\\rightarrow$%s \\\\\n' % (
+      sequence = ' '.join(Cell(x) for x in src)
+      alternates = ', '.join(' '.join(Cell(x) for x in y) for y in dest)
+      yield '%d & %s & %s$\\rightarrow$%s \\\\\n' % (
           table, ', '.join(features), sequence, alternates)
-    return data
 
 
 
@@ -722,23 +807,18 @@ class FeaturesReport(Report):
   }
 
   def Plaintext(self):
-    data = ''
-    for key, scripts in sorted(self.font.features.items()):
-      feature, tables = key
-      scriptlist = ', '.join(x for x in scripts if x)
-      data += '%4s\t%s\t%s\t%s\n' % (
-          feature, self.KNOWN_FEATURES.get(feature, 'N/A'),
-          scriptlist, ', '.join(str(x) for x in tables))
-    return data
+    return ''.join('%4s\t%s\t%s\t%s\n' % x for x in self._GetData())
 
   def XetexBody(self):
-    data = ''
+    return ''.join('%s & %s & %s & %s  \\\\\n' % x for x in self._GetData())
+
+  def _GetData(self):
+    data = []
     for key, scripts in sorted(self.font.features.items()):
       feature, tables = key
-      scriptlist = ', '.join(x.strip() for x in sorted(scripts) if x)
-      data += '%s & %s & %s & %s  \\\\\n' % (
-          feature, self.KNOWN_FEATURES.get(feature, 'N/A'),
-          scriptlist, ', '.join(str(x) for x in tables))
+      data.append((feature, self.KNOWN_FEATURES.get(feature, 'N/A'),
+                   ', '.join(x.strip() for x in sorted(scripts) if x),
+                   ', '.join(str(x) for x in tables)))
     return data
 
 
@@ -760,12 +840,9 @@ class SummaryReport(Report):
     return data
 
   def _GetData(self):
-    glyphs = self.font.glyphs
-    count = {2: 0, 3: 0, 4: 0}
-    for x in glyphs:
-      count[x.class_def] = count.get(x.class_def, 0) + 1
+    count = self.font.class_counts
     return (('Unicode characters', len(self.font.chars)),
-            ('Glyphs', len(glyphs)),
+            ('Glyphs', len(self.font.glyphs)),
             ('Ligature glyphs', count[2]),
             ('Mark glyphs', count[3]),
             ('Component glyphs', count[4]))
@@ -806,31 +883,47 @@ class Envelope(Report):
                    LigaturesReport, SubstitutionsReport)
 
   def Plaintext(self):
-    data = ''
+    data = []
     for report in self.KNOWN_REPORTS:
       try:
         content = report(self.font).Plaintext()
         if content:
-          data += report.NAME.upper() + '\n' + content + '\n\n'
+          data.append(report.NAME.upper() + '\n' + content + '\n\n')
       except AttributeError:
         pass
-    return data
-
-  def XetexBody(self):
-    data = self.FONT_TEMPLATE % os.path.split(self.font.filename)
-    data += '\\title{%s}\n' % TexEscape(self.font.GetTitle())
-    data += '\\author{%s}\n' % TexEscape(self.font.GetAuthor())
-    data += '\\renewcommand\\today{%s}' % TexEscape(
+    return ''.join(data)
+
+  def IterXetexBody(self):
+    """Generates the document body one report row at a time.
+
+    Rows are produced only when requested, so the document can be written
+    out without holding all of it in memory. Reports without a TeX body
+    are skipped.
+    """
+    yield self.FONT_TEMPLATE % os.path.split(self.font.filename)
+    yield '\\title{%s}\n' % TexEscape(self.font.GetTitle())
+    yield '\\author{%s}\n' % TexEscape(self.font.GetAuthor())
+    yield '\\renewcommand\\today{%s}' % TexEscape(
         self.font.GetName('Version', 'Unknown version'))
-    data += '\\maketitle\n\\tableofcontents\n'
+    yield '\\maketitle\n\\tableofcontents\n'
     for report in self.KNOWN_REPORTS:
+      content = report(self.font).IterXetex()
       try:
-        content = report(self.font).Xetex()
-        if content:
-          data += '\\section{%s}\n%s\n' % (report.NAME, content)
+        header = next(content, None)
       except AttributeError:
-        pass
-    return data
+        continue
+      if header is not None:
+        yield '\\section{%s}\n' % report.NAME
+        yield header
+        for piece in content:
+          yield piece
+        yield '\n'
+
+
+def CountVisibleCharacters(start, end):
+  """Counts visible characters with code points in [start, end)."""
+  category = unicodedata.category
+  return sum(1 for x in range(start, end) if category(unichr(x))[0] != 'C')
 
 
 def TexGlyph(glyph):
@@ -838,28 +931,54 @@ def TexGlyph(glyph):
 
 
 def TexEscape(name):
-  return re.sub(r'([_#&%{}\[\]])', r'\\\1', name).replace('\n', '\\\\\n')
+  return name.translate(TEX_ESCAPES)
 
 
 def ProcessPlaintext(report, output=None):
-  text = report.encode('utf-8') if hasattr(report, 'decode') else report
   if output:
-    with open(output, 'wb') as f:
-      f.write(text)
+    with io.open(output, 'w', encoding='utf-8', newline='\n') as f:
+      f.write(report)
   else:
-    print(text)
+    print(report)
 
 
 def ProcessTex(sequence, output):
   name, ext = os.path.splitext(output)
   intermediate = name + '.tex'
-  with open(intermediate, 'wb') as f:
-    for line in sequence:
-      f.write(line.encode('utf-8'))
-      f.write(b'\n')
+  with io.open(intermediate, 'w', buffering=TEX_BUFFER_SIZE,
+               encoding='utf-8', newline='\n') as f:
+    f.writelines(sequence)
+    f.write('\n')
   if ext == '.pdf':
-    subprocess.check_call(['xelatex', intermediate])
-    subprocess.check_call(['xelatex', intermediate])
+    # xelatex writes its auxiliary files into the current directory.
+    jobname = os.path.basename(name)
+    previous = ReadTexAuxFiles(jobname)
+    RunXetex(intermediate)
+    # Table of contents and references only settle on the second pass,
+    # unless they are unchanged from an earlier run on the same output.
+    if ReadTexAuxFiles(jobname) != previous:
+      RunXetex(intermediate)
+
+
+def ReadTexAuxFiles(jobname):
+  """Returns the .aux and .toc contents, with None for a missing file."""
+  contents = []
+  for ext in ('.aux', '.toc'):
+    try:
+      with open(jobname + ext, 'rb') as f:
+        contents.append(f.read())
+    except IOError:
+      contents.append(None)
+  return contents
+
+
+def RunXetex(filename):
+  try:
+    subprocess.check_call(['xelatex', '-interaction=batchmode',
+                           '-halt-on-error', filename])
+  except subprocess.CalledProcessError:
+    raise Error('xelatex failed to process %s, see %s.log for details' % (
+        filename, os.path.splitext(os.path.basename(filename))[0]))
 
 
 def BuildFontSettings(settings):
@@ -873,7 +992,7 @@ def RenderText(font, text, features, lang):
   escaped_text = TexEscape(text)
   rendered_text = r'{\customfont %s}' % escaped_text
   settings = {
-      'Scale': set('2',),
+      'Scale': ('2',),
   }
   if features or lang:
     settings['RawFeature'] = ['-rlig','-liga','-clig']
@@ -919,7 +1038,7 @@ def GetLanguageTagForFontLanguage(font_lang):
 
 
 def FontDiffOutput(font, output_file):
-  data = ''
+  data = []
 
   for table, features, langs, src, dest in font.GetGSUBItems():
     seq = ['&#x%04x;' % x if x else None
@@ -934,9 +1053,10 @@ def FontDiffOutput(font, output_file):
       lang_tag = ' lang="%s"' % LANGUAGE_TAGS.get(langs[0], langs[0])
     else:
       lang_tag = ''
-    data += '<div%s>%s = %s</div>\n' % (lang_tag, ' + '.join(seq), ''.join(seq))
+    data.append('<div%s>%s = %s</div>\n' % (
+        lang_tag, ' + '.join(seq), ''.join(seq)))
   with open(output_file, 'w') as f:
-    f.write(u'<html><body>\n%s</body></html>' % data)
+    f.write(u'<html><body>\n%s</body></html>' % ''.join(data))
 
 
 def Process(args):
@@ -964,7 +1084,7 @@ def Process(args):
       if args.output_file:
         name, ext = os.path.splitext(args.output_file)
         if ext in ('.pdf', '.tex'):
-          ProcessTex([envelope.Report(True)], args.output_file)
+          ProcessTex(envelope.IterXetex(), args.output_file)
         else:
           ProcessPlaintext(envelope.Report(False), args.output_file)
       else:
@@ -29,8 +29,9 @@ setup(
             'fontreport = fontreport.fontreport:main'
         ],
     },
+    python_requires='>=3.5',
     install_requires=[
-        'fonttools>=3.0',
+        'fonttools>=3.19',
     ],
     dependency_links=[
         'https://github.com/behdad/fonttools/tarball/master#egg=fonttools-3.0'